@@ -5,14 +5,48 @@ from __future__ import unicode_literals
 from __future__ import division
 
 import time
+import json
 import logging
+# Import before worker threads call datetime.strptime, which otherwise
+# races on its lazy import of _strptime under Python 2.
+import _strptime  # noqa: F401
+import threading
 import requests
 
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from dateutil import parser as date_parser
+from multiprocessing.pool import ThreadPool
 
 
 log = logging.getLogger(__name__)
 
+# Form fields and cookies which are not written to recorded sessions.
+SCRUBBED_FIELDS = ('username', 'password')
+RECORDED_COOKIES = ('userid',)
+SCRUBBED = '***'
+
+# Fields of the time entry dicts produced by GetMyTimeAPI.parse_entries.
+ENTRY_FIELDS = (
+    'id',
+    'employee',
+    'is_billable',
+    'is_approved',
+    'billable',
+    'approved',
+    'billable_sym',
+    'approved_sym',
+    'customer',
+    'task',
+    'comments',
+    'entry_date',
+    'entry_week',
+    'minutes',
+    'minutes_str',
+    'hours',
+    'hours_str',
+)
+
 
 def format_minutes(minutes):
     hours = minutes // 60
@@ -38,9 +72,267 @@ class InvalidTimeEntryError(Exception):
     pass
 
 
+class Response(object):
+    """
+    Replayed response with the parts of requests.Response the API uses.
+    """
+    def __init__(self, text, cookies):
+        self.text = text
+        self.cookies = cookies
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class RequestsTransport(object):
+    """
+    Send requests to service.aspx over the network.
+    """
+    def post(self, url, params, data, cookies=None):
+        return requests.post(url, params=params, data=data, cookies=cookies)
+
+
+def scrub_request(params, data):
+    """
+    Return request with credentials removed, in the form used to match
+    recorded responses.
+    """
+    data = dict((k, SCRUBBED if k in SCRUBBED_FIELDS else '{}'.format(v))
+                for k, v in data.items())
+    return {'params': params, 'data': data}
+
+
+def request_key(request):
+    return json.dumps(request, sort_keys=True)
+
+
+class RecordingTransport(object):
+    """
+    Send requests through another transport and append each request and
+    response to a JSON lines file, with credentials scrubbed.
+    """
+    def __init__(self, path, transport=None):
+        self.transport = transport or RequestsTransport()
+        self.fp = open(path, 'w')
+        self.lock = threading.Lock()
+
+    def post(self, url, params, data, cookies=None):
+        r = self.transport.post(url, params=params, data=data, cookies=cookies)
+
+        text = r.text
+        # The login response is not needed to replay a session and may
+        # identify the user, so only errors are kept. Replies which are not
+        # JSON are kept as they are and reported by login.
+        if params['method'] == 'login':
+            try:
+                if 'error' not in r.json():
+                    text = '{}'
+            except ValueError:
+                pass
+
+        record = scrub_request(params, data)
+        record['text'] = text
+        record['cookies'] = dict(
+            (k, v if k in RECORDED_COOKIES else SCRUBBED)
+            for k, v in r.cookies.items())
+
+        with self.lock:
+            self.fp.write(json.dumps(record, sort_keys=True) + '\n')
+            self.fp.flush()
+
+        return r
+
+
+class ReplayTransport(object):
+    """
+    Answer requests from a session recorded by RecordingTransport, without
+    touching the network. Identical requests get their recorded responses
+    in order; the last one is repeated once the rest are used up.
+    """
+    def __init__(self, path):
+        self.responses = {}
+        self.lock = threading.Lock()
+
+        with open(path, 'r') as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = Response(record['text'], record['cookies'])
+                key = request_key({'params': record['params'],
+                                   'data': record['data']})
+                self.responses.setdefault(key, deque()).append(response)
+
+    def post(self, url, params, data, cookies=None):
+        key = request_key(scrub_request(params, data))
+        with self.lock:
+            responses = self.responses.get(key)
+            if not responses:
+                raise GetMyTimeError('No recorded response for {}'.format(key))
+            if len(responses) > 1:
+                return responses.popleft()
+            return responses[0]
+
+
+def get_transport(record=None, replay=None):
+    if replay:
+        return ReplayTransport(replay)
+    elif record:
+        return RecordingTransport(record)
+    return RequestsTransport()
+
+
+class RateLimiter(object):
+    """
+    Space out calls to `wait` so that no more than `rate` calls per second
+    go through, no matter how many threads share the limiter.
+    """
+    def __init__(self, rate=1.0):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class PendingFetch(object):
+    """
+    Result of a week fetch that other threads can wait on.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.rows = None
+        self.error = None
+
+    def resolve(self, rows=None, error=None):
+        self.rows = rows
+        self.error = error
+        self.done.set()
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.rows
+
+
+class WeekCache(object):
+    """
+    In-memory LRU cache of raw time entry rows keyed by employee and week
+    start date. Concurrent requests for the same week share one fetch.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.weeks = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, fetch):
+        with self.lock:
+            if key in self.weeks:
+                rows = self.weeks.pop(key)
+                self.weeks[key] = rows
+                return rows
+
+            call = self.pending.get(key)
+            if call is not None:
+                owner = False
+            else:
+                owner = True
+                call = self.pending[key] = PendingFetch()
+
+        if not owner:
+            return call.result()
+
+        try:
+            rows = fetch()
+        except Exception as ex:
+            with self.lock:
+                if self.pending.get(key) is call:
+                    del self.pending[key]
+            call.resolve(error=ex)
+            raise
+
+        with self.lock:
+            # Don't store the result if the week was invalidated while
+            # the request was in flight.
+            if self.pending.get(key) is call:
+                del self.pending[key]
+                self.weeks[key] = rows
+                while len(self.weeks) > self.maxsize:
+                    self.weeks.popitem(last=False)
+        call.resolve(rows=rows)
+        return rows
+
+    def invalidate(self, employeeid, entry_date=None):
+        """
+        Drop the cached week for employeeid which contains entry_date
+        (or all weeks for employeeid if entry_date is None).
+        """
+        if entry_date is None:
+            covers = lambda key: key[0] == employeeid
+        else:
+            week = week_key(employeeid, entry_date)
+            covers = lambda key: key == week
+
+        with self.lock:
+            for key in [key for key in self.weeks if covers(key)]:
+                del self.weeks[key]
+            for key in [key for key in self.pending if covers(key)]:
+                del self.pending[key]
+
+    def remove_entry(self, id):
+        """
+        Remove deleted time entry from every cached week containing it.
+        Fetches in flight may still return the entry, and the employee is
+        unknown, so all of them are dropped.
+        """
+        id = str(id)
+        with self.lock:
+            self.pending.clear()
+            for key, rows in self.weeks.items():
+                if rows and any(row['intTimeEntryID'] == id for row in rows):
+                    rows = [row for row in rows if row['intTimeEntryID'] != id]
+                    self.weeks[key] = rows or None
+
+
+def week_start(day):
+    """
+    Return date of the Monday starting the week which contains day.
+    """
+    if isinstance(day, datetime):
+        day = day.date()
+    return day - timedelta(days=day.weekday())
+
+
+def week_key(employeeid, day):
+    return (str(employeeid), week_start(day))
+
+
+def as_datetime(day):
+    if isinstance(day, datetime):
+        return day
+    return datetime.combine(day, datetime.min.time())
+
+
 class GetMyTimeAPI(object):
     URL = 'https://app.getmytime.com/service.aspx'
 
+    def __init__(self, rate=1.0, workers=4, cache_size=256, transport=None):
+        self.transport = transport or RequestsTransport()
+        self.limiter = RateLimiter(rate)
+        self.workers = workers
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.cache = WeekCache(cache_size)
+        self.rollups = None
+
     def login(self, username, password):
         params = {
             'object': 'getmytime.api.usermanager',
@@ -51,7 +343,8 @@ class GetMyTimeAPI(object):
             'password': password,
         }
 
-        r = requests.post(self.URL, params=params, data=form_data)
+        self.limiter.wait()
+        r = self.transport.post(self.URL, params=params, data=form_data)
 
         try:
             payload = r.json()
@@ -75,8 +368,9 @@ class GetMyTimeAPI(object):
             'lookups': '[customerjobs],[serviceitems]',
         }
 
-        r = requests.post(self.URL, params=params, data=form_data,
-                          cookies=self.cookies)
+        self.limiter.wait()
+        r = self.transport.post(self.URL, params=params, data=form_data,
+                                cookies=self.cookies)
 
         payload = r.json()
         self.lookups = payload
@@ -98,8 +392,6 @@ class GetMyTimeAPI(object):
                     for row in payload['customerjobs']['rows']})),
         }
 
-        time.sleep(1)
-
     def detect_top_level_categories(self):
         tasks = self.lookupById['tasks'].values()
         customers = self.lookupById['customers'].values()
@@ -112,43 +404,99 @@ class GetMyTimeAPI(object):
                              if len(parts) > 1),
         }
 
-    def fetch_entries(self, start_date, end_date):
-        curdate = start_date
+    def fetch_week(self, employeeid, day, refresh=False):
+        """
+        Return raw time entry rows for the Monday to Sunday week containing
+        day, or None if no records were found. Weeks are served from the
+        cache unless refresh is set.
+        """
+        key = week_key(employeeid, day)
+        if refresh:
+            self.cache.invalidate(key[0], key[1])
+        return self.cache.get(
+            key, lambda: self.request_week(employeeid, key[1]))
+
+    def request_week(self, employeeid, startdate):
+        params = {
+            'object': 'getmytime.api.timeentrymanager',
+            'method': 'fetchTimeEntries',
+        }
+        form_data = {
+            'employeeid': employeeid,
+            'startdate': '{:%m/%d/%Y}'.format(startdate),
+        }
 
-        while curdate < end_date:
-            params = {
-                'object': 'getmytime.api.timeentrymanager',
-                'method': 'fetchTimeEntries',
-            }
-            form_data = {
-                'employeeid': self.cookies['userid'],
-                'startdate': '{:%m/%d/%Y}'.format(curdate),
-            }
+        self.limiter.wait()
+        r = self.transport.post(self.URL, params=params, data=form_data,
+                                cookies=self.cookies)
 
-            r = requests.post(self.URL, params=params, data=form_data,
-                              cookies=self.cookies)
+        payload = r.json()
 
-            payload = r.json()
+        if 'error' in payload:
+            raise GetMyTimeError(payload)
 
-            if 'error' in payload:
-                raise GetMyTimeError(payload)
+        rows = payload.get('rows')
 
-            try:
-                rows = payload['rows']
-            except KeyError:
-                # No records were found.
-                break
+        if self.rollups is not None:
+            self.rollups.update_week(
+                employeeid, startdate, self.parse_entries(rows or [], employeeid))
+
+        return rows
 
-            by_date = lambda entry: entry['entry_date']
-            entries = self.parse_entries(rows)
-            entries = sorted(entries, key=by_date)
+    def fetch_entries(self, start_date, end_date, employeeid=None):
+        employeeid = employeeid or self.cookies['userid']
+        return self.fetch_team_entries([employeeid], start_date, end_date)
 
-            for entry in entries:
-                if entry['entry_date'] < end_date:
-                    yield entry
+    def fetch_team_entries(self, employeeids, start_date, end_date):
+        """
+        Fetch entries for several employees at once. Weeks are requested
+        concurrently, sharing the rate limit, and yielded in the same order
+        as a serial run (by employee, then by week).
+        """
+        # Weeks are always fetched from Monday so that overlapping ranges
+        # share cached weeks; entries outside the range are filtered here.
+        start_date = as_datetime(start_date).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        end_date = as_datetime(end_date)
 
+        weeks = []
+        curdate = as_datetime(week_start(start_date))
+        while curdate < end_date:
+            weeks.append(curdate)
             curdate += timedelta(days=7)
-            time.sleep(1)
+
+        jobs = [(employeeid, week) for employeeid in employeeids
+                for week in weeks]
+        fetch_job = lambda job: (job[0], self.fetch_week(*job))
+
+        if len(jobs) > 1:
+            results = self.get_pool().imap(fetch_job, jobs)
+        else:
+            results = (fetch_job(job) for job in jobs)
+
+        for employeeid, rows in results:
+            if rows is None:
+                # No records were found for this week.
+                continue
+            for entry in self.week_entries(rows, start_date, end_date, employeeid):
+                yield entry
+
+    def get_pool(self):
+        """
+        Return thread pool shared by all concurrent fetches, creating it on
+        first use.
+        """
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+            return self.pool
+
+    def week_entries(self, rows, start_date, end_date, employeeid):
+        by_date = lambda entry: entry['entry_date']
+        entries = self.parse_entries(rows, employeeid)
+        entries = sorted(entries, key=by_date)
+        return (entry for entry in entries
+                if start_date <= entry['entry_date'] < end_date)
 
     def create_time_entry(self, startdate, enddate, customer, activity,
                           comments, tags, minutes, dry_run=False, force=False):
@@ -222,8 +570,9 @@ class GetMyTimeAPI(object):
         if dry_run:
             return
 
-        r = requests.post(self.URL, params=params, data=form_data,
-                          cookies=self.cookies)
+        self.limiter.wait()
+        r = self.transport.post(self.URL, params=params, data=form_data,
+                                cookies=self.cookies)
 
         payload = r.json()
         log.debug(payload)
@@ -231,9 +580,14 @@ class GetMyTimeAPI(object):
         if 'error' in payload:
             raise GetMyTimeError(payload)
 
-        time.sleep(1)
+        try:
+            entry_date = date_parser.parse(startdate).date()
+        except ValueError:
+            entry_date = None
+        self.cache.invalidate(str(employeeid), entry_date)
 
-    def parse_entries(self, rows):
+    def parse_entries(self, rows, employeeid=None):
+        employeeid = employeeid or self.cookies['userid']
         customers = self.lookupById['customers']
         tasks = self.lookupById['tasks']
         for row in rows:
@@ -255,6 +609,7 @@ class GetMyTimeAPI(object):
 
             yield {
                 'id': row['intTimeEntryID'],
+                'employee': employeeid,
                 'is_billable': is_billable,
                 'is_approved': is_approved,
                 'billable': 'Yes' if is_billable else 'No ',
@@ -290,12 +645,14 @@ class GetMyTimeAPI(object):
             'timeentryid': id,
         }
 
-        r = requests.post(self.URL, params=params, data=form_data,
-                          cookies=self.cookies)
+        self.limiter.wait()
+        r = self.transport.post(self.URL, params=params, data=form_data,
+                                cookies=self.cookies)
         payload = r.json()
 
         if 'error' in payload:
             raise GetMyTimeError(payload)
 
+        self.cache.remove_entry(id)
+
         log.debug(r.text)
-        time.sleep(1)
@@ -9,11 +9,14 @@ import sys
 import csv
 import argparse
 import logging
+import itertools
 
 from datetime import timedelta
 from dateutil import parser
+from multiprocessing.pool import ThreadPool
 
 from api import GetMyTimeAPI, InvalidTimeEntryError, GetMyTimeError
+from api import get_transport
 from api import log as api_log
 
 
@@ -114,6 +117,33 @@ def handle_row_action(api, row, dry_run=False):
         handle_delete_entry(api, row, dry_run)
 
 
+def process_row(api, row, dry_run=False):
+    """
+    Execute the row action and return the row as it should appear in the
+    new timesheet, or None if it should be left out.
+    """
+    if row['ID'] == 'X':
+        return None
+
+    try:
+        handle_row_action(api, row, dry_run=dry_run)
+
+    except (InvalidTimeEntryError, GetMyTimeError) as ex:
+        log.debug(row)
+        friendly_exception_log(ex)
+
+    except Exception as ex:
+        # All possible exceptions should be ignored to prevent
+        # corrupting the timesheet file.
+        log.exception(ex.message)
+
+    # Don't include deleted records in the new timesheet.
+    if row.get('Deleted', False):
+        return None
+
+    return row
+
+
 def cmd_upload(args, api):
     """
     Perform an action for each row in the timesheet CSV and produce
@@ -130,24 +160,24 @@ def cmd_upload(args, api):
 
         writer.writeheader()
 
-        for row in reader:
-            if row['ID'] == 'X':
-                continue
-            try:
-                handle_row_action(api, row, dry_run=args.dry_run)
-
-            except (InvalidTimeEntryError, GetMyTimeError) as ex:
-                log.debug(row)
-                friendly_exception_log(ex)
-
-            except Exception as ex:
-                # All possible exceptions should be ignored to prevent
-                # corrupting the timesheet file.
-                log.exception(ex.message)
-
-            # Don't include deleted records in the new timesheet.
-            if not row.get('Deleted', False):
-                writer.writerow(row)
+        handle = lambda row: process_row(api, row, dry_run=args.dry_run)
+
+        if args.jobs > 1:
+            # imap hands results back in input order, buffering rows which
+            # finish early, so the new timesheet matches a serial run.
+            pool = ThreadPool(args.jobs)
+            rows = pool.imap(handle, reader)
+        else:
+            pool = None
+            rows = itertools.imap(handle, reader)
+
+        try:
+            for row in rows:
+                if row is not None:
+                    writer.writerow(row)
+        finally:
+            if pool:
+                pool.terminate()
 
     if not args.dry_run:
         os.rename(args.filename, bakfile)
@@ -229,11 +259,16 @@ def friendly_exception_log(ex):
 
 
 def run(args):
-    username = getenv('GETMYTIME_USERNAME')
-    password = getenv('GETMYTIME_PASSWORD')
+    if args.replay:
+        username = password = ''
+    else:
+        username = getenv('GETMYTIME_USERNAME')
+        password = getenv('GETMYTIME_PASSWORD')
 
     try:
-        api = GetMyTimeAPI()
+        transport = get_transport(record=args.record, replay=args.replay)
+        api = GetMyTimeAPI(rate=0 if args.replay else args.rate,
+                           transport=transport)
         api.login(username, password)
 
         if args.cmd == 'upload':
@@ -255,12 +290,22 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Display debug messages')
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='Maximum requests per second (default: 1)')
+    parser.add_argument('--record', metavar='FILE',
+                        help='Record server requests and responses to FILE '
+                             '(credentials are scrubbed)')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='Answer server requests from a recorded FILE '
+                             'instead of the network, without rate limiting')
     subparsers = parser.add_subparsers(help='sub-command help')
 
     parser1 = subparsers.add_parser('upload')
     parser1.add_argument('filename', help='Timesheet csv')
     parser1.add_argument('--dry-run', action='store_true',
                          help='Preview changes')
+    parser1.add_argument('-j', '--jobs', type=int, default=1,
+                         help='Number of rows to process concurrently (default: 1)')
     parser1.set_defaults(cmd='upload')
 
     parser2 = subparsers.add_parser('download')
@@ -4,22 +4,49 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import division
 
+import io
 import os
 import re
 import sys
 import json
+import time
+import string
 import argparse
 import logging
+import contextlib
 import fileinput
 import itertools
+import requests
 
+from collections import Counter
 from datetime import date, datetime, timedelta
+from dateutil import parser as date_parser
 
 from api import GetMyTimeAPI, InvalidTimeEntryError, GetMyTimeError, format_minutes
+from api import ENTRY_FIELDS, get_transport
 from api import log as api_log
+from rollups import PIVOT_FIELDS, RollupIndex, pivot
 
 
 ID_REGEX = re.compile('(?P<id>\d{8})')
+FIELD_NAME_REGEX = re.compile(r'[^.[]*')
+
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# Fields compared by `ls --watch` to detect changed time entries.
+WATCH_FIELDS = (
+    'entry_date',
+    'customer',
+    'task',
+    'minutes',
+    'comments',
+    'billable',
+    'approved',
+)
+DEFAULT_ROLLUPS_PATH = os.path.expanduser('~/.getmytime-rollups.json')
+
+# Polling interval may grow up to this many times --interval after errors.
+WATCH_MAX_BACKOFF = 16
 
 log = logging.getLogger(__name__)
 
@@ -60,30 +87,172 @@ def get_date_range(args):
     return start_date, end_date
 
 
-def get_ls_tmpl(show_comments, oneline):
-    if oneline:
-        tmpl = '{id} {entry_date:%Y-%m-%d} {approved_sym}{billable_sym} ' \
-               '{hours_str:>3}{minutes_str:>3} {customer} > {task}'
-        if show_comments:
-            tmpl += '; Notes: {comments}'
-    else:
-        tmpl = 'ID: {id}\nDate: {entry_date:%Y-%m-%d}\nBillable: {billable}\n' \
-               'Approved: {approved}\nCustomer: {customer}\nTask: {task}\n' \
-               'Duration: {hours_str}{minutes_str}\nNotes: {comments}\n'
-    return tmpl
+def compile_tmpl(tmpl):
+    """
+    Return function which renders tmpl for a time entry.
+    Raises ValueError if tmpl refers to a field time entries do not have.
+    """
+    if isinstance(tmpl, bytes):
+        tmpl = tmpl.decode('utf-8')
+
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(tmpl):
+        if field_name is None:
+            continue
+
+        name = FIELD_NAME_REGEX.match(field_name).group()
+        if name not in ENTRY_FIELDS:
+            raise ValueError('Time entries do not have a "{}" field.'.format(name))
+
+    return lambda entry: tmpl.format(**entry)
+
+
+def render_oneline(entry):
+    return '%s %s %s%s %3s%3s %s > %s' % (
+        entry['id'], entry['entry_date'].strftime('%Y-%m-%d'),
+        entry['approved_sym'], entry['billable_sym'],
+        entry['hours_str'], entry['minutes_str'],
+        entry['customer'], entry['task'])
+
+
+def render_oneline_comments(entry):
+    return render_oneline(entry) + '; Notes: ' + entry['comments']
+
 
+def render_multiline(entry):
+    return 'ID: %s\nDate: %s\nBillable: %s\nApproved: %s\nCustomer: %s\n' \
+        'Task: %s\nDuration: %s%s\nNotes: %s\n' % (
+            entry['id'], entry['entry_date'].strftime('%Y-%m-%d'),
+            entry['billable'], entry['approved'], entry['customer'],
+            entry['task'], entry['hours_str'], entry['minutes_str'],
+            entry['comments'])
 
-def ls(entries, show_comments=False, oneline=False, custom_tmpl=None):
+
+def get_ls_renderer(show_comments, oneline, custom_tmpl=None):
     if custom_tmpl:
-        tmpl = custom_tmpl
+        return compile_tmpl(custom_tmpl)
+    elif oneline:
+        return render_oneline_comments if show_comments else render_oneline
     else:
-        tmpl = get_ls_tmpl(show_comments, oneline)
+        return render_multiline
+
+
+@contextlib.contextmanager
+def open_stdout(out=None):
+    """
+    Yield out if given. Otherwise yield a large buffered UTF-8 writer for
+    stdout, or sys.stdout itself when it is not backed by a real file.
+    """
+    if out is not None:
+        yield out
+        return
 
     try:
+        fileno = sys.stdout.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        yield sys.stdout
+        return
+
+    sys.stdout.flush()
+    with io.open(fileno, 'w', encoding='utf-8',
+                 buffering=OUTPUT_BUFFER_SIZE, closefd=False) as out:
+        yield out
+
+
+def ls(entries, render, out=None):
+    with open_stdout(out) as out:
         for entry in entries:
-            print(tmpl.format(**entry))
-    except KeyError as ex:
-        log.error('Invalid template: Time entries do not have a "{}" field.'.format(ex.message))
+            out.write(render(entry))
+            out.write('\n')
+
+
+def diff_entries(previous, current):
+    """
+    Compare two snapshots of time entries keyed by ID. Return lists of
+    added entries, removed entries, and (entry, changed fields) pairs.
+    """
+    by_date = lambda entry: (entry['entry_date'], entry['id'])
+
+    added = sorted((entry for id, entry in current.items()
+                    if id not in previous), key=by_date)
+    removed = sorted((entry for id, entry in previous.items()
+                      if id not in current), key=by_date)
+
+    changed = []
+    for entry in sorted(current.values(), key=by_date):
+        old_entry = previous.get(entry['id'])
+        if old_entry is None:
+            continue
+        fields = [field for field in WATCH_FIELDS
+                  if old_entry[field] != entry[field]]
+        if fields:
+            changed.append((entry, [(field, old_entry[field], entry[field])
+                                    for field in fields]))
+
+    return added, removed, changed
+
+
+def watch(api, interval, render, out=None):
+    """
+    Poll the current week every interval seconds and print time entries
+    which were added (+), removed (-), or changed (~) since the last poll.
+    """
+    employeeid = api.cookies['userid']
+    previous = {}
+    week = None
+    delay = interval
+
+    with open_stdout(out) as out:
+        try:
+            while True:
+                today = date.today()
+                startdate = today - timedelta(days=today.weekday())
+                if startdate != week:
+                    week = startdate
+                    previous = {}
+
+                poll = lambda: list(api.parse_entries(
+                    api.fetch_week(employeeid, startdate, refresh=True) or [],
+                    employeeid))
+
+                try:
+                    try:
+                        entries = poll()
+                    except KeyError:
+                        # A customer or task was added since the lookups
+                        # were fetched.
+                        api.fetch_lookups()
+                        api.detect_top_level_categories()
+                        entries = poll()
+                except (GetMyTimeError, requests.RequestException, ValueError, KeyError) as ex:
+                    delay = min(delay * 2, interval * WATCH_MAX_BACKOFF)
+                    log.warning('Polling failed, retrying in {}s: {!r}'.format(delay, ex))
+                    time.sleep(delay)
+                    continue
+
+                delay = interval
+                current = {entry['id']: entry for entry in entries}
+                added, removed, changed = diff_entries(previous, current)
+
+                for entry in removed:
+                    out.write('- ' + render(entry) + '\n')
+                for entry in added:
+                    out.write('+ ' + render(entry) + '\n')
+                for entry, fields in changed:
+                    out.write('~ ' + render(entry) + '\n')
+                    for field, old_value, new_value in fields:
+                        out.write('    {}: {} -> {}\n'.format(
+                            field, '{}'.format(old_value).strip(),
+                            '{}'.format(new_value).strip()))
+                out.flush()
+
+                # Save as we go; a watch is usually ended by a signal.
+                if api.rollups is not None:
+                    api.rollups.save()
+
+                previous = current
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
 
 
 def ls_total(entries, args):
@@ -91,9 +260,14 @@ def ls_total(entries, args):
 
     entries = list(entries)
     customer_maxlen = max(len(entry['customer']) for entry in entries)
+    employee_maxlen = max(len(str(entry['employee'])) for entry in entries)
 
-    group_by_fields = args.group_by.split(',') if args.group_by \
-        else ['entry_date']
+    if args.group_by:
+        group_by_fields = args.group_by.split(',')
+    elif args.employees:
+        group_by_fields = ['employee', 'customer']
+    else:
+        group_by_fields = ['entry_date']
 
     row_fmt = []
     for field in group_by_fields:
@@ -103,6 +277,8 @@ def ls_total(entries, args):
             row_fmt.append('{1:%Y-%m-%d}')
         elif field == 'customer':
             row_fmt.append('{2:<' + str(customer_maxlen) + '}')
+        elif field == 'employee':
+            row_fmt.append('{5!s:<' + str(employee_maxlen) + '}')
     row_fmt = ' '.join(row_fmt) + ' {3:>3}{4:>3}'
 
     entry_key = lambda entry: tuple(entry[k] for k in group_by_fields)
@@ -115,17 +291,101 @@ def ls_total(entries, args):
         entry_date = entries[0]['entry_date']
         entry_week = entries[0]['entry_week']
         customer = entries[0]['customer']
+        employee = entries[0]['employee']
 
         total = sum(entry['minutes'] for entry in entries)
         hrs, mins = format_minutes(total)
         grand_total += total
 
-        print(row_fmt.format(entry_date, entry_week, customer, hrs, mins))
+        print(row_fmt.format(entry_date, entry_week, customer, hrs, mins,
+                             employee))
 
     hrs, mins = format_minutes(grand_total)
     print('{:}{:>3}'.format(hrs, mins))
 
 
+def report(rollups, args, out=None):
+    """
+    Print pivot table of hours from the rollup index, with args.rows
+    down the side and args.cols across the top. Hours are limited to
+    args.employees, or else to the last logged in user unless the table
+    is grouped by employee.
+    """
+    if args.startdate:
+        start_date, end_date = get_date_range(args)
+    else:
+        start_date, end_date = None, None
+
+    if args.employees:
+        employeeids = args.employees.split(',')
+    elif 'employee' in (args.rows, args.cols) or rollups.user is None:
+        employeeids = None
+    else:
+        employeeids = [rollups.user]
+
+    facts = rollups.facts(start_date, end_date, employeeids)
+    rows, cols, cells = pivot(facts, args.rows, args.cols)
+
+    if not rows:
+        log.info('No time entries found. Use --refresh to fetch them first.')
+        return
+
+    hours = lambda key: '{:.2f}'.format(cells[key] / 60) if key in cells else ''
+
+    table = [[args.rows] + cols + ['Total']]
+    for row in rows:
+        table.append([row] + [hours((row, col)) for col in cols] +
+                     [hours((row, None))])
+    table.append(['Total'] + [hours((None, col)) for col in cols] +
+                 [hours((None, None))])
+
+    widths = [max(len(line[i]) for line in table) for i in range(len(table[0]))]
+
+    with open_stdout(out) as out:
+        for line in table:
+            out.write(line[0].ljust(widths[0]) + ' ' +
+                      ' '.join(cell.rjust(width) for cell, width
+                               in zip(line[1:], widths[1:])) + '\n')
+
+
+def entry_fingerprint(entry_date, customer, task, minutes, comments):
+    return (entry_date, customer.lower(), task.lower(), int(minutes),
+            comments.replace('\n', ' ').strip())
+
+
+def skip_existing_entries(api, entries):
+    """
+    Return (new, skipped) entries, where skipped entries match an entry
+    which already exists on the server. Existing entries are fetched for
+    the date span of entries in one pass.
+    """
+    if not entries:
+        return entries, []
+
+    dates = [date_parser.parse(entry['startdate']).date() for entry in entries]
+    start_date = datetime.combine(min(dates), datetime.min.time())
+    end_date = datetime.combine(max(dates), datetime.min.time()) + timedelta(days=1)
+
+    existing = Counter(
+        entry_fingerprint(entry['entry_date'].date(), entry['customer'],
+                          entry['task'], entry['minutes'], entry['comments'])
+        for entry in api.fetch_team_entries([api.cookies['userid']],
+                                            start_date, end_date))
+
+    new, skipped = [], []
+    for entry, entry_date in zip(entries, dates):
+        key = entry_fingerprint(entry_date, entry['customer'], entry['activity'],
+                                entry['minutes'], entry['comments'])
+        # Each existing entry may only account for one duplicate.
+        if existing[key] > 0:
+            existing[key] -= 1
+            skipped.append(entry)
+        else:
+            new.append(entry)
+
+    return new, skipped
+
+
 def create_entries(api, entries, **flags):
     print('Importing {} entries...'.format(len(entries)))
     for entry in entries:
@@ -143,6 +403,19 @@ def main():
     api_log.setLevel(logging.INFO)
 
     parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='maximum requests per second (default: 1)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of weeks to fetch concurrently (default: 4)')
+    parser.add_argument('--rollups',
+                        help='rollup index file, updated whenever weeks are fetched '
+                             '(default: {}, or none with --replay)'.format(DEFAULT_ROLLUPS_PATH))
+    parser.add_argument('--record', metavar='FILE',
+                        help='record server requests and responses to FILE '
+                             '(credentials are scrubbed)')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='answer server requests from a recorded FILE '
+                             'instead of the network, without rate limiting')
     subparsers = parser.add_subparsers(help='sub-command help')
 
     parser1 = subparsers.add_parser('ls')
@@ -161,7 +434,15 @@ def main():
     parser1.add_argument('--total', action='store_true',
                          help='show daily and weekly totals')
     parser1.add_argument('--group-by',
-                         help='group totals by entry_date, entry_week, or customer')
+                         help='group totals by entry_date, entry_week, customer, or employee')
+    parser1.add_argument('--employees',
+                         help='comma separated employee IDs to fetch concurrently '
+                              '(default: logged in user)')
+    parser1.add_argument('--watch', action='store_true',
+                         help='poll the current week and show changed entries '
+                              '(overrides --startdate and --enddate)')
+    parser1.add_argument('--interval', type=float, default=60,
+                         help='seconds between polls for --watch (default: 60)')
     parser1.set_defaults(cmd='ls')
 
     parser2 = subparsers.add_parser('rm')
@@ -178,6 +459,8 @@ def main():
                          help='do nothing destructive (useful for testing)')
     parser3.add_argument('-f', '--force', action='store_true',
                          help='ignore some validation rules')
+    parser3.add_argument('--dedup', action='store_true',
+                         help='skip records which already exist on the server')
     parser3.set_defaults(cmd='import')
 
     parser4 = subparsers.add_parser('lookups')
@@ -185,30 +468,87 @@ def main():
                          help='output raw values from server')
     parser4.set_defaults(cmd='lookups')
 
-    args = parser.parse_args()
+    parser5 = subparsers.add_parser('report')
+    parser5.add_argument('startdate', nargs='?',
+                         help='format: YYYY-MM-DD, inclusive (default: all time)')
+    parser5.add_argument('enddate', nargs='?',
+                         help='format: YYYY-MM-DD, exclusive (default: startdate + 7 days)')
+    parser5.add_argument('--rows', choices=PIVOT_FIELDS, default='customer',
+                         help='field to show down the side (default: customer)')
+    parser5.add_argument('--cols', choices=PIVOT_FIELDS, default='month',
+                         help='field to show across the top (default: month)')
+    parser5.add_argument('--refresh', action='store_true',
+                         help='fetch time entries for the date range before reporting '
+                              '(requires startdate)')
+    parser5.add_argument('--employees',
+                         help='comma separated employee IDs to refresh and report on '
+                              '(default: everyone when grouping by employee, '
+                              'otherwise the last logged in user)')
+    parser5.set_defaults(cmd='report', today=False)
 
-    username = getenv('GETMYTIME_USERNAME')
-    password = getenv('GETMYTIME_PASSWORD')
+    args = parser.parse_args()
 
     if not hasattr(args, 'cmd'):
         parser.print_help(sys.stderr)
         sys.exit(1)
 
+    if args.cmd == 'report' and args.refresh and not args.startdate:
+        parser5.error('--refresh requires a startdate')
+
+    if args.cmd == 'ls':
+        # Watch mode always shows one line per entry.
+        try:
+            render = get_ls_renderer(args.comments, args.oneline or args.watch,
+                                     args.tmpl)
+        except ValueError as ex:
+            parser1.error('Invalid template: {}'.format(ex))
+
+    rollups_path = args.rollups
+    if rollups_path is None and not args.replay:
+        # Replayed sessions may belong to another user, so they only update
+        # a rollup index which was asked for explicitly.
+        rollups_path = DEFAULT_ROLLUPS_PATH
+
+    if args.cmd == 'report' and rollups_path is None:
+        parser5.error('--replay requires --rollups')
+
+    rollups = RollupIndex.load(rollups_path) if rollups_path else None
+
+    if args.cmd == 'report' and not args.refresh:
+        report(rollups, args)
+        return
+
+    if args.replay:
+        username = password = ''
+    else:
+        username = getenv('GETMYTIME_USERNAME')
+        password = getenv('GETMYTIME_PASSWORD')
+
     try:
-        api = GetMyTimeAPI()
+        transport = get_transport(record=args.record, replay=args.replay)
+        api = GetMyTimeAPI(rate=0 if args.replay else args.rate,
+                           workers=args.workers, transport=transport)
+        api.rollups = rollups
         api.login(username, password)
 
-        if args.cmd == 'ls':
+        if rollups is not None:
+            rollups.set_user(api.cookies['userid'])
+
+        if args.cmd == 'ls' and args.watch:
+            watch(api, args.interval, render)
+
+        elif args.cmd == 'ls':
             start_date, end_date = get_date_range(args)
-            entries = api.fetch_entries(start_date, end_date)
+            if args.employees:
+                employeeids = args.employees.split(',')
+                entries = api.fetch_team_entries(employeeids, start_date, end_date)
+            else:
+                entries = api.fetch_entries(start_date, end_date)
 
             if args.total:
                 ls_total(entries, args)
             else:
-                ls(entries,
-                   show_comments=args.comments,
-                   oneline=args.oneline,
-                   custom_tmpl=args.tmpl)
+                ls(entries, render)
 
         elif args.cmd == 'rm':
             ids = args.ids if args.ids else detect_ids(fileinput.input('-'))
@@ -218,8 +558,24 @@ def main():
             lines = fileinput.input(args.file)
             contents = ''.join(lines)
             entries = json.loads(contents)
+
+            if args.dedup:
+                entries, skipped = skip_existing_entries(api, entries)
+                for entry in skipped:
+                    log.info('Skipping existing {} {} {}; Notes: {}'.format(
+                        entry['startdate'], entry['customer'],
+                        entry['activity'], entry['comments']))
+                log.info('Skipped {} existing entries'.format(len(skipped)))
+
             create_entries(api, entries, dry_run=args.dry_run, force=args.force)
 
+        elif args.cmd == 'report':
+            start_date, end_date = get_date_range(args)
+            employeeids = args.employees.split(',') if args.employees \
+                else [api.cookies['userid']]
+            list(api.fetch_team_entries(employeeids, start_date, end_date))
+            report(rollups, args)
+
         elif args.cmd == 'lookups':
             if args.raw:
                 print(json.dumps(api.lookups))
@@ -243,6 +599,10 @@ def main():
             log.exception(ex)
         sys.exit(1)
 
+    finally:
+        if rollups is not None:
+            rollups.save()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+
+import os
+import json
+import fcntl
+import logging
+import threading
+
+from datetime import datetime, timedelta
+
+
+log = logging.getLogger(__name__)
+
+ROLLUPS_VERSION = 1
+
+PIVOT_FIELDS = (
+    'day',
+    'week',
+    'month',
+    'year',
+    'customer',
+    'task',
+    'billable',
+    'employee',
+)
+
+
+def day_key(employeeid, day):
+    return '{}|{:%Y-%m-%d}'.format(employeeid, day)
+
+
+def read_data(path):
+    empty = {'version': ROLLUPS_VERSION, 'days': {}, 'user': None}
+    try:
+        with open(path, 'r') as fp:
+            data = json.load(fp)
+    except IOError:
+        return empty
+    except ValueError:
+        log.warning('Ignoring corrupt rollups file "{}"'.format(path))
+        return empty
+
+    if data.get('version') != ROLLUPS_VERSION:
+        return empty
+    data.setdefault('user', None)
+    return data
+
+
+class RollupIndex(object):
+    """
+    Minutes per employee, day, customer, task and billable flag, persisted
+    as JSON. Refreshing a week replaces the totals for each of its days.
+    Week, month and year totals are summed from the daily totals. The
+    index also remembers the employee ID of the last user to log in.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.days = {}
+        self.user = None
+        # Day keys updated by this process since the last save.
+        self.changed = set()
+        self.user_changed = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        index = cls(path)
+        data = read_data(path)
+        index.days = data['days']
+        index.user = data['user']
+        return index
+
+    def set_user(self, employeeid):
+        with self.lock:
+            if self.user != employeeid:
+                self.user = employeeid
+                self.user_changed = True
+
+    def save(self):
+        """
+        Write days changed by this process to the file. Other processes may
+        have saved since the file was loaded, so it is re-read under a lock
+        file and only the changed days are replaced.
+        """
+        with self.lock:
+            if not self.changed and not self.user_changed:
+                return
+            changed = dict((key, self.days.get(key)) for key in self.changed)
+            user_changed = self.user_changed
+            user = self.user
+
+        with open(self.path + '.lock', 'a') as lock_fp:
+            fcntl.flock(lock_fp, fcntl.LOCK_EX)
+            try:
+                data = read_data(self.path)
+                days = data['days']
+                for key, totals in changed.items():
+                    if totals is None:
+                        days.pop(key, None)
+                    else:
+                        days[key] = totals
+                if user_changed:
+                    data['user'] = user
+
+                tmpfile = self.path + '.tmp'
+                with open(tmpfile, 'w') as fp:
+                    json.dump(data, fp)
+                os.rename(tmpfile, self.path)
+            finally:
+                fcntl.flock(lock_fp, fcntl.LOCK_UN)
+
+        with self.lock:
+            # Keep days which changed again while saving for the next save.
+            for key, totals in changed.items():
+                if self.days.get(key) == totals:
+                    self.changed.discard(key)
+            for key in self.changed:
+                if key in self.days:
+                    days[key] = self.days[key]
+                else:
+                    days.pop(key, None)
+            self.days = days
+            if self.user == user:
+                self.user_changed = False
+
+    def update_week(self, employeeid, startdate, entries):
+        """
+        Replace totals for the 7 days starting at startdate with totals
+        summed from entries.
+        """
+        days = {}
+        for entry in entries:
+            key = day_key(employeeid, entry['entry_date'])
+            totals = days.setdefault(key, {})
+            group = (entry['customer'], entry['task'], entry['is_billable'])
+            totals[group] = totals.get(group, 0) + entry['minutes']
+
+        with self.lock:
+            for i in range(7):
+                key = day_key(employeeid, startdate + timedelta(days=i))
+                totals = days.get(key)
+                if totals is not None:
+                    totals = sorted(list(group) + [minutes]
+                                    for group, minutes in totals.items())
+                if totals == self.days.get(key):
+                    continue
+                if totals is None:
+                    del self.days[key]
+                else:
+                    self.days[key] = totals
+                self.changed.add(key)
+
+    def facts(self, start_date=None, end_date=None, employeeids=None):
+        """
+        Yield daily totals, optionally limited to [start_date, end_date)
+        and to employeeids, with every field in PIVOT_FIELDS filled in.
+        """
+        with self.lock:
+            days = list(self.days.items())
+
+        for key, totals in days:
+            employeeid, day = key.split('|')
+            if employeeids is not None and employeeid not in employeeids:
+                continue
+            day = datetime.strptime(day, '%Y-%m-%d')
+            if start_date and day < start_date:
+                continue
+            if end_date and day >= end_date:
+                continue
+
+            week = day - timedelta(days=day.weekday())
+            for customer, task, billable, minutes in totals:
+                yield {
+                    'day': '{:%Y-%m-%d}'.format(day),
+                    'week': '{:%Y-%m-%d}'.format(week),
+                    'month': '{:%Y-%m}'.format(day),
+                    'year': '{:%Y}'.format(day),
+                    'customer': customer,
+                    'task': task,
+                    'billable': 'Yes' if billable else 'No',
+                    'employee': employeeid,
+                    'minutes': minutes,
+                }
+
+
+def pivot(facts, row_field, col_field):
+    """
+    Return (rows, cols, cells) where cells maps (row, col) to total minutes.
+    Row and column totals are keyed by None.
+    """
+    cells = {}
+    for fact in facts:
+        row = fact[row_field]
+        col = fact[col_field]
+        minutes = fact['minutes']
+        for key in ((row, col), (row, None), (None, col), (None, None)):
+            cells[key] = cells.get(key, 0) + minutes
+
+    rows = sorted(set(row for row, col in cells if row is not None))
+    cols = sorted(set(col for row, col in cells if col is not None))
+    return rows, cols, cells
@@ -4,8 +4,9 @@
 # hamster records since then.
 
 # NOTE: Because getmytime.com does not store time fields, we can only
-# sync entries by day. If the latest record on getmytime.com is 1/1/2016,
-# this script will only attempt to sync records starting from 1/2/2016.
+# sync entries by day. Records from the day of the latest getmytime.com
+# entry are imported with --dedup, which skips records that already exist,
+# so a partially synced day is backfilled without duplicates.
 
 ARGS=$*
 
@@ -41,8 +42,6 @@ echo "Checking for latest getmytime.com entry..."
 dt=$(latest_entry_date)
 echo "Latest entry date found is ${dt}"
 
-# Increase latest entry by 1 day so we don't upload duplicate entries.
-dt=$(date -d "$dt + 1 day" +"%Y-%m-%d")
 echo "Uploading entries from $dt until now"
 
-$HAMSTER $dt | $GETMYTIME import $ARGS
+$HAMSTER $dt | $GETMYTIME import --dedup $ARGS